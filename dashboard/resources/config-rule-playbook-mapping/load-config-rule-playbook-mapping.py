@@ -4,12 +4,18 @@
 # SPDX-License-Identifier: MIT-0
 
 import boto3
+from botocore.config import Config
 import pandas as pd
 import json
+import hashlib
 from boto3.dynamodb.conditions import Key
 from re import sub
 import logging
 import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 
 TABLE_NAME = 'conformance-pack-compliance-playbook'
 DEFAULT_EXCEL_FILE = 'ConfigRulePlaybookMapping.xlsx'
@@ -21,6 +27,8 @@ COLUMN_NAME_LOE_HOURS = 'LOEHours'
 COLUMN_NAME_LOE_SPRINTS = 'LOESprints'
 COLUMN_NAME_SKILL_LEVEL = 'SkillLevel'
 COLUMN_NAME_RANK = 'Rank'
+COLUMN_NAMES = [COLUMN_NAME_CONFIG_RULE_ID, COLUMN_NAME_PLAYBOOK_ID, COLUMN_NAME_LOE_HOURS,
+                COLUMN_NAME_LOE_SPRINTS, COLUMN_NAME_SKILL_LEVEL, COLUMN_NAME_RANK]
 
 INCONSISTENT_NAMES = {
     "ec2-instance-managed-by-systems-manager": "ec2-instance-managed-by-ssm",
@@ -30,20 +38,98 @@ INCONSISTENT_NAMES = {
     "iam-password-policy": "iam-password-policy-check"
 }
 
+NORMALIZE_TABLE = str.maketrans('', '', '-_')
+
 DEFAULT_LOE_HOURS = 1
 DEFAULT_LOE_SPRINTS = 1
 DEFAULT_SKILL_LEVEL = 1
 DEFAULT_RANK = 1
 
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30
+)
+
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+# Retries of unprocessed keys and items in BatchGetItem and BatchWriteItem
+BATCH_RETRY_MAX_ATTEMPTS = 8
+BATCH_RETRY_BACKOFF_SECONDS = 0.05
+
 
 def build_normalized_name(id):
-    if id in INCONSISTENT_NAMES:
-        id = INCONSISTENT_NAMES[id]
-    name = str(id)
-    name = name.upper()
-    name = name.replace('-', '')
-    name = name.replace('_', '')
-    return name
+    return str(INCONSISTENT_NAMES.get(id, id)).upper().translate(NORMALIZE_TABLE)
+
+
+def backoff(attempt):
+    time.sleep(BATCH_RETRY_BACKOFF_SECONDS * 2 ** attempt +
+               random.random() * BATCH_RETRY_BACKOFF_SECONDS)
+
+
+def write_batch(table, batch):
+    request_items = {table.name: [{'PutRequest': {'Item': item}}
+                                  for item in batch]}
+    for attempt in range(BATCH_RETRY_MAX_ATTEMPTS):
+        response = table.meta.client.batch_write_item(
+            RequestItems=request_items, ReturnConsumedCapacity='NONE')
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        logging.debug(
+            "Retrying %s unprocessed items for %s", len(request_items[table.name]), table.name)
+        backoff(attempt)
+    raise RuntimeError(
+        f"Unable to write {len(request_items[table.name])} items to {table.name}")
+
+
+def bulk_write(table, items, parallelism=4):
+    iterator = iter(items)
+    batches = iter(lambda: list(islice(iterator, BATCH_WRITE_SIZE)), [])
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [executor.submit(write_batch, table, batch)
+                   for batch in batches]
+        for future in as_completed(futures):
+            future.result()
+
+
+def content_hash(item):
+    content = json.dumps(item, sort_keys=True, default=str)
+    return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
+
+def get_content_hashes(table, items):
+    hashes = {}
+    keys = [{'ConfigRuleName': item['ConfigRuleName'], 'PlaybookId': item['PlaybookId']}
+            for item in items]
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request_items = {table.name: {
+            'Keys': keys[start:start + BATCH_GET_SIZE],
+            'ProjectionExpression': '#rule, #playbook, #hash',
+            'ExpressionAttributeNames': {'#rule': 'ConfigRuleName',
+                                         '#playbook': 'PlaybookId',
+                                         '#hash': 'ContentHash'}
+        }}
+        for attempt in range(BATCH_RETRY_MAX_ATTEMPTS):
+            response = table.meta.client.batch_get_item(
+                RequestItems=request_items)
+            for existing in response['Responses'].get(table.name, []):
+                hashes[(existing['ConfigRuleName'], existing['PlaybookId'])] = existing.get(
+                    'ContentHash')
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            backoff(attempt)
+        else:
+            raise RuntimeError(
+                f"Unable to read {len(request_items[table.name]['Keys'])} keys from {table.name}")
+    return hashes
+
+
+def value_or_default(column, default):
+    return column.astype(str).where(column.astype(bool), default)
 
 
 def init_parser() -> argparse.ArgumentParser:
@@ -71,52 +157,38 @@ def main():
     excel_file = args.excel_file
     region = args.region
 
-    dynamodb = boto3.resource('dynamodb', region_name=region)
+    dynamodb = boto3.resource(
+        'dynamodb', region_name=region, config=BOTO_CONFIG)
     table = dynamodb.Table(TABLE_NAME)
 
     sheet = pd.read_excel(excel_file)
+    sheet = sheet.reindex(columns=COLUMN_NAMES, fill_value='')
     sheet.fillna('', inplace=True)
 
-    items = []
-    keys = {}
-    for index, row in sheet[0:].iterrows():
-        config_rule_id = row.get(COLUMN_NAME_CONFIG_RULE_ID)
-        playbook_id = row.get(COLUMN_NAME_PLAYBOOK_ID)
-        if config_rule_id and playbook_id:
-            logging.info(
-                f"Config Rule Id: {config_rule_id}, Playbook Id: {playbook_id}")
-            item = {}
-            item['ConfigRuleName'] = build_normalized_name(config_rule_id)
-            item['PlaybookId'] = playbook_id
-            key = item['ConfigRuleName'] + '_' + item['PlaybookId']
-            if key not in keys:
-                keys[key] = 1
-                loe_hours = row.get(COLUMN_NAME_LOE_HOURS)
-                if loe_hours:
-                    item['LOEHours'] = str(loe_hours)
-                else:
-                    item['LOEHours'] = str(DEFAULT_LOE_HOURS)
-                loe_sprints = row.get(COLUMN_NAME_LOE_SPRINTS)
-                if loe_sprints:
-                    item['LOESprints'] = str(loe_sprints)
-                else:
-                    item['LOESprints'] = DEFAULT_LOE_SPRINTS
-                skill_level = row.get(COLUMN_NAME_SKILL_LEVEL)
-                if skill_level:
-                    item['SkillLevel'] = str(skill_level)
-                else:
-                    item['SkillLevel'] = DEFAULT_SKILL_LEVEL
-                rank = row.get(COLUMN_NAME_RANK)
-                if rank:
-                    item['Rank'] = str(rank)
-                else:
-                    item['Rank'] = DEFAULT_RANK
-                items.append(item)
-
-    if items and len(items) > 0:
-        with table.batch_writer() as batch:
-            for i in range(0, len(items)):
-                batch.put_item(Item=items[i])
+    sheet = sheet[sheet[COLUMN_NAME_CONFIG_RULE_ID].astype(bool) &
+                  sheet[COLUMN_NAME_PLAYBOOK_ID].astype(bool)]
+    mapping = pd.DataFrame({
+        'ConfigRuleName': sheet[COLUMN_NAME_CONFIG_RULE_ID].map(build_normalized_name),
+        'PlaybookId': sheet[COLUMN_NAME_PLAYBOOK_ID],
+        'LOEHours': value_or_default(sheet[COLUMN_NAME_LOE_HOURS], str(DEFAULT_LOE_HOURS)),
+        'LOESprints': value_or_default(sheet[COLUMN_NAME_LOE_SPRINTS], DEFAULT_LOE_SPRINTS),
+        'SkillLevel': value_or_default(sheet[COLUMN_NAME_SKILL_LEVEL], DEFAULT_SKILL_LEVEL),
+        'Rank': value_or_default(sheet[COLUMN_NAME_RANK], DEFAULT_RANK)
+    })
+    mapping.drop_duplicates(['ConfigRuleName', 'PlaybookId'], inplace=True)
+    items = mapping.to_dict('records')
+    logging.info(f"Config Rule Playbook Mappings: {len(items)}")
+
+    # Only write the mappings that are new or have changed since the last load
+    for item in items:
+        item['ContentHash'] = content_hash(item)
+    existing_hashes = get_content_hashes(table, items)
+    to_write = [item for item in items
+                if existing_hashes.get((item['ConfigRuleName'], item['PlaybookId'])) != item['ContentHash']]
+    logging.info(f"Config Rule Playbook Mappings Changed: {len(to_write)}")
+
+    if to_write and len(to_write) > 0:
+        bulk_write(table, to_write)
 
 
 if __name__ == '__main__':
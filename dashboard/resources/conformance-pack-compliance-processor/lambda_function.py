@@ -7,6 +7,15 @@ import json
 import urllib.parse
 import os
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from threading import BoundedSemaphore, Event, Lock
+from queue import Full, Queue
+from botocore.config import Config
+from boto3.dynamodb.conditions import Key
+from collections import namedtuple
+from functools import partial
 from decimal import Decimal
 
 logger = logging.getLogger()
@@ -15,191 +24,412 @@ logger.setLevel(logging.INFO)
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
+CONFORMANCE_PACK_INFIX = '-CONFORMANCE-PACK-'
+NORMALIZE_TABLE = str.maketrans('', '', '-_')
+
+# Packs without evaluation results report INSUFFICIENT_DATA instead of a score
+NO_SCORE = Decimal(-1)
+NO_SCORE_VALUES = (None, '', 'INSUFFICIENT_DATA')
+
+# Largest page sizes accepted by the Config APIs
+SCORE_PAGE_SIZE = 20
+DETAIL_PAGE_SIZE = 100
+
+MAX_WORKERS = 8
+# Pages buffered per conformance pack while earlier packs are processed
+PAGE_QUEUE_SIZE = 2
+QUEUE_PUT_TIMEOUT_SECONDS = 0.1
+
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF_SECONDS = 0.05
+
+HEDGE_DEFAULT_DELAY_SECONDS = 0.5
+LATENCY_ALPHA = 0.125
+LATENCIES = {}
+# Every call earns a tenth of a hedge, so throttling that slows every call
+# past the hedge delay duplicates at most about one call in ten
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_MAX = 4
+HEDGE_TOKENS = HEDGE_BUDGET_MAX
+HEDGE_LOCK = Lock()
+# Duplicates run on their own pool so they never queue behind a stuck
+# primary, and both pools leave room for losing calls still in flight
+CALL_EXECUTOR = ThreadPoolExecutor(max_workers=2 * MAX_WORKERS)
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=2 * MAX_WORKERS)
+
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30
+)
+
+# Clients and playbooks are kept in module scope so warm invocations reuse them
+DYNAMODB = boto3.resource(
+    'dynamodb', region_name=os.environ['AWS_REGION'], config=BOTO_CONFIG)
+# A second client keeps hedged requests off the primary connection pool
+CONFIG_CLIENTS = (boto3.client('config', config=BOTO_CONFIG),
+                  boto3.client('config', config=BOTO_CONFIG))
+
+Playbook = namedtuple(
+    'Playbook', ['PlaybookId', 'LOEHours', 'LOESprints', 'SkillLevel', 'Rank'])
+
+PLAYBOOK_TTL_SECONDS = 900
+PLAYBOOK_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+PLAYBOOKS = {}
+PLAYBOOKS_LOADED_AT = None
+
 
 def process_scores(summary_response):
-    scores = []
     compliance_scores = summary_response.get('ConformancePackComplianceScores')
     for compliance_score in compliance_scores:
-        score = {}
-        score['ConformancePackName'] = compliance_score.get(
-            'ConformancePackName')
-        try:
-            score['Score'] = Decimal(compliance_score.get('Score'))
-        except:
-            score['Score'] = Decimal(-1.0)
-        scores.append(score)
-    return scores
+        raw_score = compliance_score.get('Score')
+        yield {
+            'ConformancePackName': compliance_score.get('ConformancePackName'),
+            'Score': NO_SCORE if raw_score in NO_SCORE_VALUES else Decimal(raw_score)
+        }
 
 
 def process_details(detail_response):
-    evaluations = []
     conformance_pack_name = detail_response.get('ConformancePackName')
     results = detail_response.get('ConformancePackRuleEvaluationResults')
     for result in results:
-        evaluation = {}
-        evaluation['ConformancePackName'] = conformance_pack_name
-        evaluation['ComplianceType'] = result.get('ComplianceType')
-        qualifier = result.get('EvaluationResultIdentifier').get(
-            'EvaluationResultQualifier')
-        evaluation['ConfigRuleNameResourceId'] = qualifier.get(
-            'ConfigRuleName') + qualifier.get('ResourceId')
-        evaluation['ConfigRuleName'] = qualifier.get('ConfigRuleName')
-        evaluation['ResourceType'] = qualifier.get('ResourceType')
-        evaluation['ResourceId'] = qualifier.get('ResourceId')
-        evaluations.append(evaluation)
-    return evaluations
+        qualifier = result['EvaluationResultIdentifier']['EvaluationResultQualifier']
+        config_rule_name = qualifier['ConfigRuleName']
+        resource_id = qualifier['ResourceId']
+        yield {
+            'ConformancePackName': conformance_pack_name,
+            'ComplianceType': result['ComplianceType'],
+            'ConfigRuleNameResourceId': config_rule_name + resource_id,
+            'ConfigRuleName': config_rule_name,
+            'ResourceType': qualifier['ResourceType'],
+            'ResourceId': resource_id
+        }
 
 
 def get_prefix(config_rule_name):
 
     config_rule_name = config_rule_name.upper()
-    i = config_rule_name.find('-CONFORMANCE-PACK-')
+    i = config_rule_name.find(CONFORMANCE_PACK_INFIX)
     if i != -1:
         prefix = config_rule_name[:i]
     else:
         prefix = config_rule_name
-    prefix = prefix.replace('-', '')
-    return prefix
-
+    return prefix.translate(NORMALIZE_TABLE)
 
-def process_remediations(detail_response, playbooks, remediations, keys):
-
-    logger.debug("Before Process Remediations...")
-    logger.debug(f"  Remediations: {remediations}")
-    logger.debug(f"  Keys: {keys}")
 
+def get_non_compliant(detail_response):
+    # Normalize each non-compliant rule name once per page, for both the
+    # playbook lookup and the remediations
+    non_compliant = []
     results = detail_response.get('ConformancePackRuleEvaluationResults')
     for result in results:
-        if result.get('ComplianceType') == 'NON_COMPLIANT':
-            qualifier = result.get('EvaluationResultIdentifier').get(
-                'EvaluationResultQualifier')
-            prefix = get_prefix(qualifier.get('ConfigRuleName'))
-            logger.debug(f"Prefix: {prefix}")
-            config_playbooks = playbooks.get(prefix)
-            if config_playbooks:
-                logger.debug("Config Playbooks found")
-                for playbook in config_playbooks:
-                    playbook_id = playbook['PlaybookId']
-                    key = prefix + playbook_id + qualifier.get('ResourceId')
-                    if key in keys:
-                        logger.debug(f"key: {key} exists")
-                    else:
-                        keys[key] = 1
-                        remediation = {}
-                        remediation['ConfigRuleNamePlaybookIdResourceId'] = key
-                        remediation['ConfigRuleName'] = qualifier.get(
-                            'ConfigRuleName')
-                        remediation['ConfigRuleNamePrefix'] = prefix
-                        remediation['PlaybookId'] = playbook_id
-                        remediation['ResourceType'] = qualifier.get(
-                            'ResourceType')
-                        remediation['ResourceId'] = qualifier.get('ResourceId')
-                        remediation['LOEHours'] = playbook['LOEHours']
-                        remediation['LOESprints'] = playbook['LOESprints']
-                        remediation['SkillLevel'] = playbook['SkillLevel']
-                        remediation['Rank'] = playbook['Rank']
-                        remediations.append(remediation)
-
-    logger.debug("After Process Remediations...")
-    logger.debug(f"  Remediations: {remediations}")
-    logger.debug(f"  Keys: {keys}")
-
-    return remediations, keys
-
-
-def get_details(summary_response, config_client, table_detail, table_remediation, playbooks):
-    details = []
-    remediations = []
-    keys = {}
+        if result['ComplianceType'] == 'NON_COMPLIANT':
+            qualifier = result['EvaluationResultIdentifier']['EvaluationResultQualifier']
+            non_compliant.append((qualifier, get_prefix(qualifier['ConfigRuleName'])))
+    return non_compliant
+
+
+def process_remediations(non_compliant, playbooks, keys):
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Before Process Remediations...")
+        logger.debug("  Keys: %s", keys)
+
+    for qualifier, prefix in non_compliant:
+        config_rule_name = qualifier['ConfigRuleName']
+        resource_id = qualifier['ResourceId']
+        logger.debug("Prefix: %s", prefix)
+        config_playbooks = playbooks.get(prefix)
+        if config_playbooks:
+            logger.debug("Config Playbooks found")
+            for playbook in config_playbooks:
+                playbook_id = playbook.PlaybookId
+                key = prefix + playbook_id + resource_id
+                if key in keys:
+                    logger.debug("key: %s exists", key)
+                    continue
+                keys.add(key)
+                yield {
+                    'ConfigRuleNamePlaybookIdResourceId': key,
+                    'ConfigRuleName': config_rule_name,
+                    'ConfigRuleNamePrefix': prefix,
+                    'PlaybookId': playbook_id,
+                    'ResourceType': qualifier['ResourceType'],
+                    'ResourceId': resource_id,
+                    'LOEHours': playbook.LOEHours,
+                    'LOESprints': playbook.LOESprints,
+                    'SkillLevel': playbook.SkillLevel,
+                    'Rank': playbook.Rank
+                }
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("After Process Remediations...")
+        logger.debug("  Keys: %s", keys)
+
+
+def write_batch(table, batch):
+    request_items = {table.name: [{'PutRequest': {'Item': item}}
+                                  for item in batch]}
+    for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+        response = table.meta.client.batch_write_item(
+            RequestItems=request_items, ReturnConsumedCapacity='NONE')
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        logger.debug(
+            "Retrying %s unprocessed items for %s", len(request_items[table.name]), table.name)
+        time.sleep(BATCH_WRITE_BACKOFF_SECONDS * 2 ** attempt +
+                   random.random() * BATCH_WRITE_BACKOFF_SECONDS)
+    raise RuntimeError(
+        f"Unable to write {len(request_items[table.name])} items to {table.name}")
+
+
+class BatchWriter:
+    """
+        Buffers items and writes every BATCH_WRITE_SIZE of them with
+        write_batch on a bounded thread pool, so callers can stream items
+        into a table without holding them all in memory
+    """
+
+    def __init__(self, table, parallelism=4):
+        self._table = table
+        self._items = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=parallelism)
+        self._slots = BoundedSemaphore(2 * parallelism)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._flush()
+            for future in as_completed(self._futures):
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+    def put_item(self, Item):
+        self._items.append(Item)
+        if len(self._items) == BATCH_WRITE_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._items:
+            return
+        self._slots.acquire()
+        future = self._executor.submit(write_batch, self._table, self._items)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        self._items = []
+
+
+def hedge_delay(operation_name):
+    with HEDGE_LOCK:
+        latency = LATENCIES.get(operation_name)
+    if latency is None:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    average, deviation = latency
+    return average + 4 * deviation
+
+
+def record_latency(operation_name, elapsed):
+    with HEDGE_LOCK:
+        latency = LATENCIES.get(operation_name)
+        if latency is None:
+            LATENCIES[operation_name] = (elapsed, elapsed / 2)
+        else:
+            average, deviation = latency
+            deviation += LATENCY_ALPHA * (abs(elapsed - average) - deviation)
+            average += LATENCY_ALPHA * (elapsed - average)
+            LATENCIES[operation_name] = (average, deviation)
+
+
+def earn_hedge():
+    global HEDGE_TOKENS
+    with HEDGE_LOCK:
+        HEDGE_TOKENS = min(HEDGE_BUDGET_MAX, HEDGE_TOKENS + HEDGE_BUDGET_RATIO)
+
+
+def spend_hedge():
+    global HEDGE_TOKENS
+    with HEDGE_LOCK:
+        if HEDGE_TOKENS < 1:
+            return False
+        HEDGE_TOKENS -= 1
+        return True
+
+
+def timed_call(operation, **kwargs):
+    started = time.monotonic()
+    response = operation(**kwargs)
+    return response, time.monotonic() - started
+
+
+def hedged_call(clients, operation_name, **kwargs):
+    primary, secondary = clients
+    earn_hedge()
+    pending = {CALL_EXECUTOR.submit(
+        timed_call, getattr(primary, operation_name), **kwargs)}
+    done, pending = wait(pending, timeout=hedge_delay(operation_name))
+    if pending and spend_hedge():
+        logger.debug("Hedging slow %s call", operation_name)
+        pending.add(HEDGE_EXECUTOR.submit(
+            timed_call, getattr(secondary, operation_name), **kwargs))
+    # Take the first call to succeed and only raise once every call failed
+    while True:
+        for future in done:
+            if future.exception() is None:
+                response, elapsed = future.result()
+                record_latency(operation_name, elapsed)
+                return response
+        if not pending:
+            raise done.pop().exception()
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+
+def paginate(operation, **kwargs):
+    # Config has no boto3 paginators for these operations, so follow
+    # NextToken the same way a paginator would
+    response = operation(**kwargs)
+    while response:
+        yield response
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+        logger.debug("nextToken: %s", next_token)
+        response = operation(NextToken=next_token, **kwargs)
+
+
+def fetch_pages(config_clients, conformance_pack_name):
+    operation = partial(hedged_call, config_clients,
+                        'get_conformance_pack_compliance_details')
+    for detail_response in paginate(operation, ConformancePackName=conformance_pack_name,
+                                     Limit=DETAIL_PAGE_SIZE):
+        logger.debug(
+            "get_conformance_pack_compliance_details response: %s", detail_response)
+        yield detail_response
+
+
+def put_page(page_queue, page, stop):
+    # Give up once the consumer has stopped, so a full queue never blocks
+    # the producer and the executor shutdown forever
+    while not stop.is_set():
+        try:
+            page_queue.put(page, timeout=QUEUE_PUT_TIMEOUT_SECONDS)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def queue_pages(config_clients, conformance_pack_name, page_queue, stop):
+    try:
+        pages = fetch_pages(config_clients, conformance_pack_name)
+        # Check stop before every call, so producers that only start once the
+        # consumer has failed do not call Config at all
+        while not stop.is_set():
+            detail_response = next(pages, None)
+            if detail_response is None or not put_page(page_queue, detail_response, stop):
+                return
+    finally:
+        put_page(page_queue, None, stop)
+
+
+def get_details(summary_response, config_clients, table_detail, table_remediation, table_playbook, playbooks):
+    keys = set()
     compliance_scores = summary_response.get('ConformancePackComplianceScores')
-    for compliance_score in compliance_scores:
-        conformance_pack_name = compliance_score.get('ConformancePackName')
-        detail_response = config_client.get_conformance_pack_compliance_details(
-            ConformancePackName=conformance_pack_name)
-        if detail_response:
-            logger.debug(
-                f"get_conformance_pack_compliance_details response: {detail_response}")
-            details.extend(process_details(detail_response))
-            remediations, keys = process_remediations(
-                detail_response, playbooks, remediations, keys)
-            next_token = detail_response.get('NextToken')
-            while next_token:
-                logger.debug(f"nextToken: {next_token}")
-                detail_response = config_client.get_conformance_pack_compliance_details(
-                    ConformancePackName=conformance_pack_name, NextToken=next_token)
-                if detail_response:
-                    details.extend(process_details(detail_response))
-                    remediations, keys = process_remediations(
-                        detail_response, playbooks, remediations, keys)
-                    next_token = detail_response.get('NextToken')
-    if details and len(details) > 0:
-        with table_detail.batch_writer() as batch:
-            for i in range(0, len(details)):
-                batch.put_item(Item=details[i])
-    if remediations and len(remediations) > 0:
-        with table_remediation.batch_writer() as batch:
-            for i in range(0, len(remediations)):
-                batch.put_item(Item=remediations[i])
+    # Fetch the details of each conformance pack concurrently, but process
+    # the pages on this thread in listing order so the first pack to report
+    # a remediation key keeps it, as it would if the packs were fetched one
+    # after another, and stream the results straight into DynamoDB
+    page_queues = [Queue(maxsize=PAGE_QUEUE_SIZE) for _ in compliance_scores]
+    stop = Event()
+    with BatchWriter(table_detail) as detail_batch, \
+            BatchWriter(table_remediation) as remediation_batch, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(queue_pages, config_clients,
+                                   compliance_score.get('ConformancePackName'), page_queue, stop)
+                   for compliance_score, page_queue in zip(compliance_scores, page_queues)]
+        try:
+            for page_queue in page_queues:
+                for detail_response in iter(page_queue.get, None):
+                    for detail in process_details(detail_response):
+                        detail_batch.put_item(Item=detail)
+                    non_compliant = get_non_compliant(detail_response)
+                    playbooks = load_playbooks(
+                        table_playbook, {prefix for _, prefix in non_compliant}, playbooks)
+                    for remediation in process_remediations(non_compliant, playbooks, keys):
+                        remediation_batch.put_item(Item=remediation)
+        finally:
+            # Release any producers still waiting on their queues, otherwise
+            # an error above would leave the executor waiting on them
+            stop.set()
+        for future in futures:
+            future.result()
     return
 
 
-def load_playbooks(table_playbook):
-    response = table_playbook.scan()
-    logger.debug(f"Scan Response {response}")
+def query_playbooks(table_playbook, config_rule_name):
+    client = table_playbook.meta.client
+    key_condition = Key('ConfigRuleName').eq(config_rule_name)
+    response = client.query(TableName=table_playbook.name,
+                            KeyConditionExpression=key_condition)
     data = response['Items']
     while 'LastEvaluatedKey' in response:
-        response = table_playbook.scan(
-            ExclusiveStartKey=response['LastEvaluatedKey'])
+        response = client.query(TableName=table_playbook.name,
+                                KeyConditionExpression=key_condition,
+                                ExclusiveStartKey=response['LastEvaluatedKey'])
         data.extend(response['Items'])
-    logger.debug(f"Scan Response Items: {data}")
-    playbooks = {}
-    for datum in data:
-        if datum['ConfigRuleName'] not in playbooks:
-            playbooks[datum['ConfigRuleName']] = []
-        playbook = {}
-        playbook['PlaybookId'] = datum['PlaybookId']
-        playbook['LOEHours'] = datum['LOEHours']
-        playbook['LOESprints'] = datum['LOESprints']
-        playbook['SkillLevel'] = datum['SkillLevel']
-        playbook['Rank'] = datum['Rank']
-        playbooks[datum['ConfigRuleName']].append(playbook)
-
-    logger.debug(f"Playbooks (Processed Items): {playbooks}")
+    return data
+
+
+def load_playbooks(table_playbook, prefixes, playbooks):
+    # Only query the config rules that have not been loaded yet, rules
+    # without any playbooks are cached as an empty tuple
+    missing = [prefix for prefix in prefixes if prefix not in playbooks]
+    if not missing:
+        return playbooks
+    responses = PLAYBOOK_EXECUTOR.map(
+        lambda prefix: query_playbooks(table_playbook, prefix), missing)
+    for prefix, data in zip(missing, responses):
+        logger.debug("Query Response Items for %s: %s", prefix, data)
+        playbooks[prefix] = tuple(
+            Playbook(datum['PlaybookId'], datum['LOEHours'], datum['LOESprints'],
+                     datum['SkillLevel'], datum['Rank'])
+            for datum in data)
+
+    logger.debug("Playbooks (Processed Items): %s", playbooks)
 
     return playbooks
 
 
 def lambda_handler(event, context):
+    global PLAYBOOKS, PLAYBOOKS_LOADED_AT
     table_summary_name = os.environ['SUMMARY_TABLE_NAME']
     table_detail_name = os.environ['DETAIL_TABLE_NAME']
     table_playbook_name = os.environ['PLAYBOOK_TABLE_NAME']
     table_remediation_name = os.environ['REMEDIATION_TABLE_NAME']
     logger.info(
         f"Summary Table Name: {table_summary_name}, Detail Table Name: {table_detail_name}, Playbook Table Name: {table_playbook_name}, Remediation Table Name: {table_remediation_name}")
-    dynamodb = boto3.resource('dynamodb', region_name=os.environ['AWS_REGION'])
-    table_summary = dynamodb.Table(table_summary_name)
-    table_detail = dynamodb.Table(table_detail_name)
-    table_playbook = dynamodb.Table(table_playbook_name)
-    table_remediation = dynamodb.Table(table_remediation_name)
-    config_client = boto3.client('config')
-    scores = []
-    playbooks = load_playbooks(table_playbook)
-    summary_response = config_client.list_conformance_pack_compliance_scores()
-    if summary_response:
-        get_details(summary_response, config_client,
-                    table_detail, table_remediation, playbooks)
-        scores.extend(process_scores(summary_response))
-        next_token = summary_response.get('NextToken')
-        while next_token:
-            logger.debug(f"nextToken: {next_token}")
-            summary_response = config_client.list_conformance_pack_compliance_scores(
-                NextToken=next_token)
-            get_details(summary_response, config_client,
-                        table_detail, table_remediation, playbooks)
-            scores.extend(process_scores(summary_response))
-            next_token = summary_response.get('NextToken')
-    if scores and len(scores) > 0:
-        with table_summary.batch_writer() as batch:
-            for i in range(0, len(scores)):
-                batch.put_item(Item=scores[i])
-    return
\ No newline at end of file
+    table_summary = DYNAMODB.Table(table_summary_name)
+    table_detail = DYNAMODB.Table(table_detail_name)
+    table_playbook = DYNAMODB.Table(table_playbook_name)
+    table_remediation = DYNAMODB.Table(table_remediation_name)
+    config_clients = CONFIG_CLIENTS
+    config_client = config_clients[0]
+    if PLAYBOOKS_LOADED_AT is None or time.monotonic() - PLAYBOOKS_LOADED_AT > PLAYBOOK_TTL_SECONDS:
+        PLAYBOOKS = {}
+        PLAYBOOKS_LOADED_AT = time.monotonic()
+    playbooks = PLAYBOOKS
+    with BatchWriter(table_summary) as summary_batch:
+        for summary_response in paginate(config_client.list_conformance_pack_compliance_scores,
+                                         Limit=SCORE_PAGE_SIZE):
+            get_details(summary_response, config_clients,
+                        table_detail, table_remediation, table_playbook, playbooks)
+            for score in process_scores(summary_response):
+                summary_batch.put_item(Item=score)
+    return
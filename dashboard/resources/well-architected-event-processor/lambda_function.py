@@ -7,6 +7,11 @@ import json
 import urllib.parse
 import os
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Event, Lock
+from botocore.config import Config
+from queue import Full, Queue
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,6 +20,144 @@ logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 logging.getLogger('wellarchitected').setLevel(logging.CRITICAL)
 
+# Clients are created per event and make a handful of calls at a time, so
+# the default connection pool is enough; adaptive retries slow down when the
+# Well-Architected API throttles
+BOTO_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=3,
+    read_timeout=30
+)
+
+# Errors that retrying the event cannot fix. Anything else, such as
+# throttling, fails the invocation so the event is retried
+NON_RETRYABLE_ERROR_CODES = ('AccessDeniedException', 'ResourceNotFoundException',
+                             'ValidationException')
+
+# Largest page size accepted by ListAnswers, which has no boto3 paginator
+ANSWER_PAGE_SIZE = 50
+QUEUE_PUT_TIMEOUT_SECONDS = 0.1
+
+HEDGE_DEFAULT_DELAY_SECONDS = 0.5
+LATENCY_ALPHA = 0.125
+LATENCIES = {}
+# Every call earns a tenth of a hedge, so throttling that slows every call
+# past the hedge delay duplicates at most about one call in ten
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_MAX = 2
+HEDGE_TOKENS = HEDGE_BUDGET_MAX
+HEDGE_LOCK = Lock()
+
+
+def hedge_delay(operation_name):
+    with HEDGE_LOCK:
+        latency = LATENCIES.get(operation_name)
+    if latency is None:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    average, deviation = latency
+    return average + 4 * deviation
+
+
+def record_latency(operation_name, elapsed):
+    with HEDGE_LOCK:
+        latency = LATENCIES.get(operation_name)
+        if latency is None:
+            LATENCIES[operation_name] = (elapsed, elapsed / 2)
+        else:
+            average, deviation = latency
+            deviation += LATENCY_ALPHA * (abs(elapsed - average) - deviation)
+            average += LATENCY_ALPHA * (elapsed - average)
+            LATENCIES[operation_name] = (average, deviation)
+
+
+def earn_hedge():
+    global HEDGE_TOKENS
+    with HEDGE_LOCK:
+        HEDGE_TOKENS = min(HEDGE_BUDGET_MAX, HEDGE_TOKENS + HEDGE_BUDGET_RATIO)
+
+
+def spend_hedge():
+    global HEDGE_TOKENS
+    with HEDGE_LOCK:
+        if HEDGE_TOKENS < 1:
+            return False
+        HEDGE_TOKENS -= 1
+        return True
+
+
+def timed_call(operation, **kwargs):
+    started = time.monotonic()
+    response = operation(**kwargs)
+    return response, time.monotonic() - started
+
+
+def hedged_call(client, operation_name, **kwargs):
+    operation = getattr(client, operation_name)
+    earn_hedge()
+    # Only one list_answers call is in flight at a time, so each call gets its
+    # own two workers and a losing call finishes in the background. The
+    # duplicate shares the client, and with it the adaptive rate limiter
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        pending = {executor.submit(timed_call, operation, **kwargs)}
+        done, pending = wait(pending, timeout=hedge_delay(operation_name))
+        if pending and spend_hedge():
+            logger.debug("Hedging slow %s call", operation_name)
+            pending.add(executor.submit(timed_call, operation, **kwargs))
+        # Take the first call to succeed and only raise once every call failed
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    response, elapsed = future.result()
+                    record_latency(operation_name, elapsed)
+                    return response
+            if not pending:
+                raise done.pop().exception()
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def append_risks(answer_summaries, risks, workload_id_lens_alias, workload_id, workload_name, lens_alias, lens_name):
+    for answer_summary in answer_summaries:
+        risk = {}
+        risk['WorkloadIdLensAlias'] = workload_id_lens_alias
+        risk['QuestionId'] = answer_summary['QuestionId']
+        risk['WorkloadId'] = workload_id
+        risk['WorkloadName'] = workload_name
+        risk['LensAlias'] = lens_alias
+        risk['LensName'] = lens_name
+        risk['QuestionTitle'] = answer_summary['QuestionTitle']
+        risk['Risk'] = answer_summary['Risk']
+        risks.put_item(Item=risk)
+
+
+def put_page(page_queue, page, stop):
+    # The handler sets stop if it fails while building risks, after which
+    # nothing will take pages off the queue
+    while not stop.is_set():
+        try:
+            page_queue.put(page, timeout=QUEUE_PUT_TIMEOUT_SECONDS)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def queue_answer_pages(waf, workload_id, lens_alias, next_token, page_queue, stop):
+    try:
+        logger.debug("nextToken: %s", next_token)
+        while next_token:
+            answers = hedged_call(
+                waf, 'list_answers', WorkloadId=workload_id, LensAlias=lens_alias,
+                MaxResults=ANSWER_PAGE_SIZE, NextToken=next_token)
+            if not put_page(page_queue, answers, stop):
+                return
+            next_token = answers.get('NextToken')
+            logger.debug("nextToken: %s", next_token)
+    finally:
+        put_page(page_queue, None, stop)
+
 
 def lambda_handler(event, context):
     request_parameters = event.get('detail').get('requestParameters')
@@ -27,80 +170,58 @@ def lambda_handler(event, context):
             lens_alias = urllib.parse.unquote(lens_alias)
             logger.info(
                 f"Event: {event_name}, WorkloadId: {workload_id}, LensAlias: {lens_alias}, QuestionId:{question_id}")
-            logger.debug("Received event: " + json.dumps(event, indent=2))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received event: %s", json.dumps(event, indent=2))
             # List Answers for WorkloadId and LensAlias
             answer = {}
-            risks = []
             try:
-                waf = boto3.client('wellarchitected')
+                waf = boto3.client('wellarchitected', config=BOTO_CONFIG)
                 workload = waf.get_workload(WorkloadId=workload_id)
                 lens = waf.get_lens(LensAlias=lens_alias)
-                answers = waf.list_answers(
-                    WorkloadId=workload_id, LensAlias=lens_alias)
+                answers = hedged_call(
+                    waf, 'list_answers', WorkloadId=workload_id, LensAlias=lens_alias,
+                    MaxResults=ANSWER_PAGE_SIZE)
             except botocore.exceptions.ParamValidationError as e:
-                logger.error("ERROR - Parameter validation error: %s" % e)
+                logger.error("ERROR - Parameter validation error: %s", e)
+                return
             except botocore.exceptions.ClientError as e:
-                logger.error("ERROR - Unexpected error: %s" % e)
-            except botocore.exceptions.ValidationException as e:
-                logger.error("ERROR - Validation error: %s" % e)
-            except botocore.exceptions.InternalServerException as e:
-                logger.error("ERROR - Internal server error: %s" % e)
-            except botocore.exceptions.ResourceNotFoundException as e:
-                logger.error("ERROR - Resource Not Found error: %s" % e)
-            except botocore.exceptions.AccessDeniedException as e:
-                logger.error("ERROR - Access Denied error: %s" % e)
-            except botocore.exceptions.ThrottlingException as e:
-                logger.error("ERROR - Throttling error: %s" % e)
+                error_code = e.response.get('Error', {}).get('Code')
+                logger.error("ERROR - %s error: %s", error_code, e)
+                if error_code not in NON_RETRYABLE_ERROR_CODES:
+                    raise
+                return
 
-            answer['WorkloadId'] = workload_id
-            answer['LensAlias'] = lens_alias
-            answer['AnswerSummaries'] = []
-            answer['AnswerSummaries'].append(answers.get('AnswerSummaries'))
-
-            for answer_summary in answers.get('AnswerSummaries'):
-                risk = {}
-                risk['WorkloadIdLensAlias'] = workload_id + lens_alias
-                risk['QuestionId'] = answer_summary['QuestionId']
-                risk['WorkloadId'] = workload_id
-                risk['WorkloadName'] = workload.get(
-                    'Workload').get('WorkloadName')
-                risk['LensAlias'] = lens_alias
-                risk['LensName'] = lens.get('Lens').get('Name')
-                risk['QuestionTitle'] = answer_summary['QuestionTitle']
-                risk['Risk'] = answer_summary['Risk']
-                risks.append(risk)
+            workload_name = workload['Workload']['WorkloadName']
+            lens_name = lens['Lens']['Name']
+            workload_id_lens_alias = workload_id + lens_alias
 
-            next_token = answers.get('NextToken')
-            logger.debug(f"nextToken: ${next_token}")
-            while next_token:
-                answers = waf.list_answers(
-                    WorkloadId=workload_id, LensAlias=lens_alias, NextToken=next_token)
-                answer['AnswerSummaries'].append(
-                    answers.get('AnswerSummaries'))
-                next_token = answers.get('NextToken')
-
-                for answer_summary in answers.get('AnswerSummaries'):
-                    risk = {}
-                    risk['WorkloadIdLensAlias'] = workload_id + lens_alias
-                    risk['QuestionId'] = answer_summary['QuestionId']
-                    risk['WorkloadId'] = workload_id
-                    risk['WorkloadName'] = workload.get(
-                        'Workload').get('WorkloadName')
-                    risk['LensAlias'] = lens_alias
-                    risk['LensName'] = lens.get('Lens').get('Name')
-                    risk['QuestionTitle'] = answer_summary['QuestionTitle']
-                    risk['Risk'] = answer_summary['Risk']
-                    risks.append(risk)
-
-                logger.debug(f"nextToken: ${next_token}")
-
-            # Insert in dynamodb
+            # Insert in dynamodb as the risks are built
             dynamodb = boto3.resource(
-                'dynamodb', region_name=os.environ['AWS_REGION'])
+                'dynamodb', region_name=os.environ['AWS_REGION'], config=BOTO_CONFIG)
             table = dynamodb.Table(os.environ['TABLE_NAME'])
             table_risks = dynamodb.Table(os.environ['RISKS_TABLE_NAME'])
+
+            answer['WorkloadId'] = workload_id
+            answer['LensAlias'] = lens_alias
+
+            # Fetch the remaining pages in the background while the risks
+            # for the pages already received are built
+            page_queue = Queue(maxsize=2)
+            stop = Event()
+            with table_risks.batch_writer() as batch, ThreadPoolExecutor(max_workers=1) as executor:
+                producer = executor.submit(queue_answer_pages, waf, workload_id, lens_alias,
+                                           answers.get('NextToken'), page_queue, stop)
+                try:
+                    while answers is not None:
+                        append_risks(answers.get('AnswerSummaries', ()), batch, workload_id_lens_alias,
+                                     workload_id, workload_name, lens_alias, lens_name)
+                        answers = page_queue.get()
+                finally:
+                    # Release the producer if it is still waiting on the queue,
+                    # otherwise an error above would leave the executor waiting on it
+                    stop.set()
+                producer.result()
+
             table.put_item(Item=answer)
-            for risk in risks:
-                table_risks.put_item(Item=risk)
 
     return
\ No newline at end of file